@@ -9,31 +9,40 @@
 
      SnowLines
      1. Import AVL data as points
-     2. Add coordinate information
-     3. Create lines with direction out of the AVL points
+     2. Sort the points by plow and time straight from their coordinate fields
+     3. Create lines with direction out of each plow's points in a worker process
+     4. Copy the lines into the Snow dataset once RouteStats is finished
 
      RouteStats
      1. Import RoadwayInformation
      2. Dissolve based off of snow route type
      3. Add statistical fields
-     4. Calculate each field while looping through route types, each loop creating a new layer
-     5. Merge all route types into one large layer
+     4. Calculate each field for every route type in its own process, each route type creating a new layer
+     5. Combine all route types into one large layer
 
  REQUIREMENTS
 
      Python 3
      arcpy
+     numpy
  """
 
 import arcpy
+import json
+import logging
+import multiprocessing
+import numpy
 import os
 import sys
 import traceback
-sys.path.insert(0, "C:/Scripts")
-import Logging
+import types
+from concurrent.futures import ProcessPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
 
 # Environment
 arcpy.env.overwriteOutput = True
+arcpy.env.parallelProcessingFactor = "100%"
+arcpy.SetLogHistory(False)
 spatial_reference = arcpy.SpatialReference(3436)
 
 # Folders
@@ -52,10 +61,14 @@ snow_dataset = os.path.join(telemetry, "Snow")
 
 # Snow tracks
 avl_24 = os.path.join(telemetry, "avl_24")
+avl_48 = os.path.join(telemetry, "avl_48")
 avl_48_simple = os.path.join(telemetry, "avl_48_simple")
 avl_plow_lines = os.path.join(snow_dataset, "avlPlowLines")
+avl_plow_lines_temp = os.path.join("memory", "avlPlowLines")
+avl_48_simple_temp = os.path.join("memory", "avl_48_simple")
 dissolved_routes = os.path.join(snow_dataset, "DissolvedRoutes")
-dissolved_routes_temp = os.path.join(snow_dataset, "DissolvedRoutesTemp")
+dissolved_routes_signature = os.path.join(data, "DissolvedRoutes.json")  # RoadwayInformation state DissolvedRoutes was built from
+dissolved_routes_temp = os.path.join("memory", "DissolvedRoutesTemp")
 dissolved_routes_simple = os.path.join(snow_dataset, "DissolvedRoutesSimple")
 avl_plow_traffic_all_dest = os.path.join(snow_dataset, "avlPlowTrafficAll")
 avl_plow_traffic_1_dest = os.path.join(snow_dataset, "avlPlowTraffic1")  # Trouble spots
@@ -67,119 +80,263 @@ avl_plow_traffic_4_dest = os.path.join(snow_dataset, "avlPlowTraffic4")  # Secti
 avl_table_24 = os.path.join(avl_root, r"AVL.dbo.vw_AVLpLow24")
 avl_table_48 = os.path.join(avl_root, r"AVL.dbo.vw_AVLpLow48")
 
+# Filters, written once so every query built from them has the same text
+avl_24_filter = "TEMPORAL < 25 AND spd <= 35"
+avl_48_filter = "spd <= 100"
+roadway_filter = "SNOW_FID <> 'NORTE'"
+snow_type_filter = "SNOW_TYPE = '{}' AND SUM_LN_TOTALMI IS NOT NULL"
+
+# Route dissolve, saved with the RoadwayInformation signature so changing any of them rebuilds DissolvedRoutes
+dissolve_fields = ["SNOW_DIST", "SNOW_TYPE", "ROAD_NAME", "SNOW_FID", "SNOW__RT_NBR"]
+dissolve_statistics = "LN_TOTALMI SUM"
+dissolve_unsplit_lines = "UNSPLIT_LINES"
+
+# Logging, records from worker processes are drained by the listener in the main process
+log_queue = None
+
+
+def worker_insert(name, level):
+    """Stand-in for Logging.insert in worker processes, logging the start and finish of a step"""
+    def decorator(function):
+        def wrapper(*args, **kwargs):
+            Logging.logger.info(f"{'---' * level}START {name}")
+            result = function(*args, **kwargs)
+            Logging.logger.info(f"{'---' * level}FINISH {name}")
+            return result
+        return wrapper
+    return decorator
+
+
+# Spawned workers re-import this script, they skip the shared Logging module so only the main process ever opens the log file
+if __name__ == "__mp_main__":
+    Logging = types.SimpleNamespace(logger=logging.getLogger("SnowTelemetry"), insert=worker_insert)
+else:
+    sys.path.insert(0, "C:/Scripts")
+    import Logging
+
+
+def init_worker(records):
+    """Initializer for worker processes, sending their log records to the main process and running their tools serially"""
+
+    # The main process handlers decide what is written, so every record is sent
+    Logging.logger.setLevel(logging.DEBUG)
+    Logging.logger.handlers = [QueueHandler(records)]
+
+    # The pools supply the parallelism, so each worker's tools stay in one process instead of oversubscribing the cores
+    arcpy.env.parallelProcessingFactor = "0"
+
+
+def signature_matches(path, signature):
+    """Whether the signature saved at path is the given one, a missing signature never matches"""
+    if signature is None or not os.path.exists(path):
+        return False
+    with open(path) as signature_file:
+        return json.load(signature_file) == signature
+
+
+def save_signature(path, signature):
+    """Save the signature at path, or forget the saved one when there is no signature"""
+    if signature is None:
+        if os.path.exists(path):
+            os.remove(path)
+    else:
+        with open(path, "w") as signature_file:
+            json.dump(signature, signature_file)
+
 
 # Move raw plow data into a working GDB
 @Logging.insert("Initialize", 1)
 def initialize():
 
     # 24 Hour
-    arcpy.MakeFeatureLayer_management(avl_table_24, "avlTable24", "TEMPORAL < 25 and spd <= 35")
-    arcpy.FeatureClassToFeatureClass_conversion("avlTable24", telemetry, "avl_24")
+    arcpy.ExportFeatures_conversion(avl_table_24, avl_24, avl_24_filter)
 
     # 48 Hour
-    arcpy.MakeFeatureLayer_management(avl_table_48, "avlTable48", "spd <= 100")
-    arcpy.FeatureClassToFeatureClass_conversion("avlTable48", telemetry, "avl_48")
+    arcpy.ExportFeatures_conversion(avl_table_48, avl_48, avl_48_filter)
 
 
 @Logging.insert("Snow Lines", 1)
 def snow_lines():
     """Convert AVL points to lines"""
-    arcpy.MakeXYEventLayer_management(avl_24, "lon", "lat", "avlPlowPoints", spatial_reference)
-    arcpy.FeatureClassToFeatureClass_conversion("avlPlowPoints", snow_dataset, "avlPlowPoints")
-    arcpy.PointsToLine_management("avlPlowPoints", avl_plow_lines, "unitName", "datetime", "NO_CLOSE")
+
+    # Sort the points by truck then time and find where each truck's track starts
+    points = arcpy.da.TableToNumPyArray(avl_24, ["unitName", "datetime", "lon", "lat"], skip_nulls=True)
+    points = points[numpy.lexsort((points["datetime"], points["unitName"]))]
+    track_starts = numpy.flatnonzero(points["unitName"][1:] != points["unitName"][:-1]) + 1
+
+    # Write one line per truck, a single point cannot make a line
+    unit_name = arcpy.ListFields(avl_24, "unitName")[0]
+    arcpy.CreateFeatureclass_management("memory", "avlPlowLines", "POLYLINE", spatial_reference=spatial_reference)
+    arcpy.AddField_management(avl_plow_lines_temp, "unitName", "TEXT", field_length=unit_name.length)
+    with arcpy.da.InsertCursor(avl_plow_lines_temp, ["SHAPE@", "unitName"]) as cursor:
+        for track in numpy.split(points, track_starts):
+            if len(track) > 1:
+                vertices = arcpy.Array([arcpy.Point(x, y) for x, y in zip(track["lon"], track["lat"])])
+                cursor.insertRow([arcpy.Polyline(vertices, spatial_reference), track["unitName"][0]])
+
+
+def roadway_signature():
+    """Row count and latest edit of RoadwayInformation, or None when editor tracking is off and changes cannot be detected"""
+    description = arcpy.Describe(roadway_information)
+    if not description.editorTrackingEnabled:
+        return None
+
+    # Versioned edits stay out of the base table until a compress, so those are read through a cursor on the version instead
+    if description.isVersioned:
+        with arcpy.da.SearchCursor(roadway_information, description.editedAtFieldName) as cursor:
+            edit_dates = [row[0] for row in cursor]
+        return [len(edit_dates), str(max(filter(None, edit_dates), default=None))]
+    count, latest = arcpy.ArcSDESQLExecute(sde).execute(f"SELECT COUNT(*), MAX({description.editedAtFieldName}) FROM {os.path.basename(roadway_information)}")[0]
+    return [int(count), str(latest)]
+
+
+def summarize_snow_type(snow_type, summary_folder):
+    """Summarize nearby AVL points and calculate statistics for one route type in a worker process, returning its summary in summary_folder"""
+    Logging.logger.info(f"---------START {snow_type[2]}")
+
+    # Each route type gets its own layer and temp table
+    routes_layer = f"DissolvedRoutes_{snow_type[2]}"
+    routes_temp = f"{dissolved_routes_temp}_{snow_type[2]}"
+
+    # Summarize
+    arcpy.MakeFeatureLayer_management(dissolved_routes, routes_layer, snow_type[0])
+    arcpy.SummarizeNearby_analysis(routes_layer, avl_24, routes_temp, "STRAIGHT_LINE", snow_type[1], "FEET")
+
+    # Calculate the statistics for every route at once, scaling against the maximum dotsperlanemile per route type
+    routes = arcpy.da.TableToNumPyArray(routes_temp, ["OID@", "Point_Count", "SUM_LN_TOTALMI"], null_value=0)
+    lane_miles = routes["SUM_LN_TOTALMI"]
+    dots = numpy.divide(routes["Point_Count"], lane_miles, out=numpy.zeros(len(routes)), where=lane_miles != 0)
+    maximum = float(dots.max()) if dots.size else 0.0
+    percentage = dots / maximum * 100 if maximum else numpy.zeros(len(routes))
+    statistics = dict(zip(routes["OID@"].tolist(), zip(dots.tolist(), percentage.tolist(), numpy.log1p(percentage).tolist())))
+
+    # Write the statistics back in one pass
+    with arcpy.da.UpdateCursor(routes_temp, ["OID@", "dotsperlanemile", "dotsperlanemilemax", "percentage", "log_percentage"]) as cursor:
+        for row in cursor:
+            dots_per_lane_mile, route_percentage, log_percentage = statistics[row[0]]
+            cursor.updateRow([row[0], dots_per_lane_mile, maximum, route_percentage, log_percentage])
+
+    # The memory workspace belongs to this process, so hand the summary back through a GDB of its own in the parent's folder
+    summary_gdb = os.path.join(summary_folder, f"{snow_type[2]}.gdb")
+    if not arcpy.Exists(summary_gdb):
+        arcpy.CreateFileGDB_management(summary_folder, f"{snow_type[2]}.gdb")
+    summary = os.path.join(summary_gdb, snow_type[2])
+    arcpy.CopyFeatures_management(routes_temp, summary)
+    arcpy.Delete_management(routes_temp)
+    Logging.logger.info(f"---------FINISH {snow_type[2]}")
+    return summary
 
 
 @Logging.insert("Route Stats", 1)
 def route_stats():
     """Add statistics fields and statistics to the new lines"""
 
-    # Create new routes then save to the GDB
-    Logging.logger.info(f"------START Dissolve")
-    arcpy.MakeFeatureLayer_management(roadway_information, "RoadwayInformation", "SNOW_FID <> 'NORTE'")
-    arcpy.Dissolve_management("RoadwayInformation", dissolved_routes, ["SNOW_DIST", "SNOW_TYPE", "ROAD_NAME", "SNOW_FID", "SNOW__RT_NBR"], "LN_TOTALMI SUM", unsplit_lines="UNSPLIT_LINES")
-    arcpy.MakeFeatureLayer_management(dissolved_routes, "DissolvedRoutes")
-    Logging.logger.info(f"------FINISH Dissolve")
-
-    # Add/calculate fields
-    Logging.logger.info(f"------START Add/Calculate Fields")
-    arcpy.AddFields_management("DissolvedRoutes",
-                               [["dotsperlanemile", "double", "Dots Per Lane Mile"],
-                                ["dotsperlanemilemax", "double", "Max Dots per Lane Mile"],
-                                ["percentage", "double", "Percentage"],
-                                ["log_percentage", "double", "log1p(percentage)"]])
-    arcpy.MakeFeatureLayer_management(avl_table_24, "avl_table", "TEMPORAL < 25 and spd <= 35")
-    Logging.logger.info(f"------FINISH Add/Calculate Fields")
+    # Reuse the routes from the last run when RoadwayInformation has not been edited since and the dissolve is the same
+    signature = roadway_signature()
+    if signature is not None:
+        signature += [roadway_filter, dissolve_fields, dissolve_statistics, dissolve_unsplit_lines]
+    if arcpy.Exists(dissolved_routes) and signature_matches(dissolved_routes_signature, signature):
+        Logging.logger.info(f"------SKIP Dissolve, RoadwayInformation and dissolve unchanged")
+    else:
+        # Forget the old signature first so a failed rebuild is never mistaken for a current one
+        save_signature(dissolved_routes_signature, None)
+
+        # Create new routes then save to the GDB
+        Logging.logger.info(f"------START Dissolve")
+        arcpy.MakeFeatureLayer_management(roadway_information, "RoadwayInformation", roadway_filter)
+        arcpy.Dissolve_management("RoadwayInformation", dissolved_routes, dissolve_fields, dissolve_statistics, unsplit_lines=dissolve_unsplit_lines)
+        Logging.logger.info(f"------FINISH Dissolve")
+
+        # Add/calculate fields
+        Logging.logger.info(f"------START Add/Calculate Fields")
+        arcpy.AddFields_management(dissolved_routes,
+                                   [["dotsperlanemile", "double", "Dots Per Lane Mile"],
+                                    ["dotsperlanemilemax", "double", "Max Dots per Lane Mile"],
+                                    ["percentage", "double", "Percentage"],
+                                    ["log_percentage", "double", "log1p(percentage)"]])
+        Logging.logger.info(f"------FINISH Add/Calculate Fields")
+        save_signature(dissolved_routes_signature, signature)
 
     # Summarized layer iteration list
-    # [0]=selection definition query, [1]=buffer radius, [2]=final destination
-    snow_types = [["SNOW_TYPE = '1' And SUM_LN_TOTALMI IS NOT NULL", 50, "avlPlowTraffic1"],
-                  ["SNOW_TYPE = '2' And SUM_LN_TOTALMI IS NOT NULL", 50, "avlPlowTraffic2"],
-                  ["SNOW_TYPE = '3' And SUM_LN_TOTALMI IS NOT NULL", 25, "avlPlowTraffic3"],
-                  ["SNOW_TYPE = '4' And SUM_LN_TOTALMI IS NOT NULL", 25, "avlPlowTraffic4"]]
+    # [0]=selection definition query, [1]=buffer radius, [2]=layer name, [3]=final destination
+    snow_types = [[snow_type_filter.format(1), 50, "avlPlowTraffic1", avl_plow_traffic_1_dest],
+                  [snow_type_filter.format(2), 50, "avlPlowTraffic2", avl_plow_traffic_2_dest],
+                  [snow_type_filter.format(3), 25, "avlPlowTraffic3", avl_plow_traffic_3_dest],
+                  [snow_type_filter.format(4), 25, "avlPlowTraffic4", avl_plow_traffic_4_dest]]
 
-    # Create four layers using the above list
+    # Create four layers using the above list, each route type is independent so they are summarized in separate processes
     Logging.logger.info(f"------START Snow Type Layers")
-    for snow_type in snow_types:
-        Logging.logger.info(f"---------START {snow_type[2]}")
-
-        # Summarize
-        route_selection = arcpy.SelectLayerByAttribute_management("DissolvedRoutes", "NEW_SELECTION", snow_type[0])
-        arcpy.SummarizeNearby_analysis(route_selection, "avl_table", dissolved_routes_temp, "STRAIGHT_LINE", snow_type[1], "FEET")
-        arcpy.MakeFeatureLayer_management(dissolved_routes_temp, "DissolvedRoutesTemp")
-        arcpy.CalculateField_management("DissolvedRoutesTemp", "dotsperlanemile", "!Point_Count!/!SUM_LN_TOTALMI!", "PYTHON3")
-
-        # Find maximum dotsperlanemile value per route type
-        maximum = 0.0
-        clause = (None, "ORDER BY dotsperlanemile DESC")
-        with arcpy.da.SearchCursor("DissolvedRoutesTemp", "dotsperlanemile", sql_clause=clause) as cursor:
-            for row in cursor:
-                maximum = row[0]
-                if maximum != 0.0:
-                    break
-        del cursor
-
-        arcpy.CalculateFields_management("DissolvedRoutesTemp", "PYTHON3",
-                                         [["dotsperlanemilemax", f"{maximum}"],
-                                          ["percentage", "(!dotsperlanemile!/!dotsperlanemilemax!)*100"],
-                                          ["log_percentage", "math.log1p(!percentage!)"]])
-        arcpy.FeatureClassToFeatureClass_conversion("DissolvedRoutesTemp", snow_dataset, f"{snow_type[2]}")
-        Logging.logger.info(f"---------FINISH {snow_type[2]}")
+    # The summaries go to this process's scratch folder, a worker's own is removed by arcpy when the worker exits
+    with ProcessPoolExecutor(max_workers=len(snow_types), initializer=init_worker, initargs=(log_queue,)) as executor:
+        summaries = list(executor.map(summarize_snow_type, snow_types, [arcpy.env.scratchFolder] * len(snow_types)))
+
+        # Only this process writes to the Snow dataset, so the workers never contend for its locks
+        for snow_type, summary in zip(snow_types, summaries):
+            arcpy.CopyFeatures_management(summary, snow_type[3])
+        arcpy.CopyFeatures_management(summaries[0], avl_plow_traffic_all_dest)
+        arcpy.Append_management(summaries[1:], avl_plow_traffic_all_dest, "NO_TEST")
+        arcpy.Delete_management([os.path.dirname(summary) for summary in summaries])
     Logging.logger.info(f"------FINISH Snow Type Layers")
 
-    # Merge the sum tables into one new layer
-    Logging.logger.info(f"------START Merge")
-    arcpy.Merge_management([avl_plow_traffic_1_dest, avl_plow_traffic_2_dest, avl_plow_traffic_3_dest, avl_plow_traffic_4_dest], avl_plow_traffic_all_dest)
-    Logging.logger.info(f"------FINISH Merge")
-
 
 @Logging.insert("Simple Points", 1)
 def simple_points():
     """Simplify AVL points into one feature for display on a web map"""
-    arcpy.Dissolve_management("avlTable48", avl_48_simple, "Temporal")
+    arcpy.Dissolve_management(avl_48, avl_48_simple_temp, "Temporal")
 
 
 @Logging.insert("Simple Routes", 1)
 def simple_routes():
     """Simplify snow routes by district and priority for display on a web map"""
-    arcpy.MakeFeatureLayer_management(roadway_information, "RoadwayInformation", "SNOW_FID <> 'NORTE'")
-    arcpy.Dissolve_management("RoadwayInformation", dissolved_routes_simple, ["SNOW_DIST", "SNOW_TYPE"])
+    arcpy.PairwiseDissolve_analysis(dissolved_routes, dissolved_routes_simple, ["SNOW_DIST", "SNOW_TYPE"])
+
+
+def tracks(tracks_folder):
+    """Snow lines followed by simple points in a worker process, both only read the AVL copies, returning their copies in tracks_folder"""
+    snow_lines()
+    simple_points()
+
+    # The memory workspace belongs to this process, so hand the tracks back through a GDB in the parent's folder
+    tracks_gdb = os.path.join(tracks_folder, "Tracks.gdb")
+    if not arcpy.Exists(tracks_gdb):
+        arcpy.CreateFileGDB_management(tracks_folder, "Tracks.gdb")
+    plow_lines = os.path.join(tracks_gdb, "avlPlowLines")
+    simple_plow_points = os.path.join(tracks_gdb, "avl_48_simple")
+    arcpy.CopyFeatures_management(avl_plow_lines_temp, plow_lines)
+    arcpy.CopyFeatures_management(avl_48_simple_temp, simple_plow_points)
+    arcpy.Delete_management([avl_plow_lines_temp, avl_48_simple_temp])
+    return plow_lines, simple_plow_points
 
 
 if __name__ == "__main__":
-    traceback_info = traceback.format_exc()
+    # Hand log records from this and every worker process to a background thread so geoprocessing never waits on log output
+    log_queue = multiprocessing.Queue(-1)
+    log_listener = QueueListener(log_queue, *Logging.logger.handlers, respect_handler_level=True)
+    Logging.logger.handlers = [QueueHandler(log_queue)]
+    log_listener.start()
+
     try:
         Logging.logger.info("Script Execution Started")
         initialize()
-        snow_lines()
-        route_stats()
-        simple_points()
-        simple_routes()
+
+        # The AVL tracks are built in a worker process while this process runs the routes, handed back through this process's scratch folder
+        with ProcessPoolExecutor(max_workers=1, initializer=init_worker, initargs=(log_queue,)) as executor:
+            tracks_built = executor.submit(tracks, arcpy.env.scratchFolder)
+            route_stats()
+            simple_routes()
+            plow_lines, simple_plow_points = tracks_built.result()
+
+            # Only this process writes to Telemetry.gdb, so the tracks are copied in once the routes are done with it
+            arcpy.CopyFeatures_management(plow_lines, avl_plow_lines)
+            arcpy.CopyFeatures_management(simple_plow_points, avl_48_simple)
+            arcpy.Delete_management(os.path.dirname(plow_lines))
         Logging.logger.info("Script Execution Finished")
     except (IOError, NameError, KeyError, IndexError, TypeError, UnboundLocalError, ValueError):
-        Logging.logger.info(traceback_info)
-    except NameError:
-        print(traceback_info)
-    except arcpy.ExecuteError:
-        Logging.logger.error(arcpy.GetMessages(2))
+        Logging.logger.info(traceback.format_exc())
+    except arcpy.ExecuteError as error:
+        Logging.logger.error(error)
     except:
         Logging.logger.info("An unspecified exception occurred")
+        Logging.logger.info(traceback.format_exc())
+    finally:
+        log_listener.stop()